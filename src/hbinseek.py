@@ -37,11 +37,17 @@ Current state:
 
     - Save/load numpy array.
     - Provides metadata in separated json file.
+    - Restore metadata from log file (records logged after the metadata was last written are
+      replayed when reading).
+    - Read chunks of an array.
+    - Compress array to write (zlib) and uncompress to read.
     
 Future work:
 
-    - Restore metadata from log file.
-    - Compress array to write and uncompress to read (provide chunks).
+    - Compress arrays in independent chunks (so that reading a chunk doesn't need to
+      uncompress the data before it).
+    - Rotate the log in segments (so that segments whose records are all in the metadata
+      can be archived or removed).
     - Document format and provide a C API for the format.
     - Write a custom numpy structure (i.e.: table) and provide a way to retrieve one of its columns.
 
@@ -53,8 +59,15 @@ https://github.com/numpy/numpy/blob/master/numpy/lib/format.py
 
 from __future__ import unicode_literals
 
+import errno
+import json
+import marshal
+import mmap
+import os
+import struct
 import sys
-import weakref
+import threading
+import zlib
 
 import numpy
 
@@ -65,19 +78,326 @@ if PY3_ONWARDS:
     # Alias for backward-compatibility (open is redefined in this module).
     file = open
     text_type = str
+    integer_types = (int,)
+    import queue
 else:
     VALID_ATTR_TYPES = (int, long, float, unicode, bytes)
     text_type = unicode
+    integer_types = (int, long)
+    import Queue as queue
+
+BINARY_HEADER = b'%BINSEEK v002\n'
+LOG_HEADER = b'%BINSEEKLOG v002\n'
+
+# Header of the log of the first version of the format (where records referred to groups by
+# name and not by path -- the groups of such a file may only be loaded from its metadata).
+LOG_HEADER_V001 = b'%BINSEEKLOG v001\n'
+
+# Number of bytes written to the log after which the metadata is rewritten (so that readers
+# don't have to replay a long log tail).
+DEFAULT_COMPACT_THRESHOLD = 16 * 1024 * 1024
+
+# Size of the buffer of the binary data and of the log records pending to be written when
+# autoflush is off (so that many small records are written with a single syscall).
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Records bigger than this are written directly to the file (instead of being copied to the
+# buffer of the stream first) when autoflush is off.
+DIRECT_WRITE_THRESHOLD = 128 * 1024
+
+# Header of the metadata cache file: it's a marshal dump, so, it's only valid for the same Python
+# version and marshal version which wrote it.
+METADATA_CACHE_HEADER = (
+    '%%BINSEEKMETA v001 py%s.%s marshal%s\n' % (sys.version_info[0], sys.version_info[1], marshal.version)
+).encode('ascii')
+
+# Header used when the marshal dump in the metadata cache file is compressed with zlib (done when
+# it's bigger than the threshold below, where writing/reading it is I/O-bound).
+METADATA_CACHE_ZLIB_HEADER = METADATA_CACHE_HEADER[:-1] + b' zlib\n'
+METADATA_CACHE_COMPRESS_THRESHOLD = 1024 * 1024
+
+# Exact types saved as is (note: bool is a subclass of int, but it's saved with its own type,
+# so, it's not converted to int as other subclasses).
+_VALID_ATTR_TYPES_SET = frozenset(VALID_ATTR_TYPES + (bool,))
+
+# Compressions accepted for the array data (None means no compression).
+VALID_COMPRESSIONS = (None, 'zlib')
 
 PACK_UNSIGNED_LONG = '<L'  # < means we're using little-endian format
-MAX_UNSIGNED_LONG = 2 ** 64 - 1
+MAX_UNSIGNED_LONG = 2 ** 32 - 1  # PACK_UNSIGNED_LONG has a standard size of 4 bytes.
 PACK_DOUBLE = '<d'
 PACK_LONG_LONG = '<q'
+PACK_BOOL = '<?'
+MIN_LONG_LONG = -2 ** 63
+MAX_LONG_LONG = 2 ** 63 - 1
+
+# Pre-compiled structs (so that the format isn't parsed at each pack).
+STRUCT_UNSIGNED_LONG = struct.Struct(PACK_UNSIGNED_LONG)
+STRUCT_DOUBLE = struct.Struct(PACK_DOUBLE)
+STRUCT_LONG_LONG = struct.Struct(PACK_LONG_LONG)
+STRUCT_BOOL = struct.Struct(PACK_BOOL)
+
+# Structs to pack the dimension and the size in each dimension of a shape (indexed by the
+# dimension).
+SHAPE_STRUCTS = tuple(struct.Struct('<%dL' % (ndim + 1)) for ndim in range(9))
+
+
+def _sized_field_len(field_bytes):
+    '''
+    :return int:
+        The number of bytes needed to pack the given bytes with _pack_sized_field_into.
+    '''
+    return STRUCT_UNSIGNED_LONG.size + len(field_bytes) + 1
+
+
+def _pack_sized_field_into(buf, offset, field_bytes):
+    '''
+    Packs the size of the given bytes (unsigned long), the bytes and a ':' separator into the
+    buffer at the given offset.
+
+    :return int:
+        The offset right after the packed field.
+    '''
+    STRUCT_UNSIGNED_LONG.pack_into(buf, offset, len(field_bytes))
+    offset += STRUCT_UNSIGNED_LONG.size
+    end = offset + len(field_bytes)
+    buf[offset:end] = field_bytes
+    buf[end:end + 1] = b':'
+    return end + 1
+
+
+# dtype representation -> numpy.dtype (files usually have many arrays with few distinct dtypes).
+_DTYPE_CACHE = {}
+
+
+# numpy.dtype -> dtype representation as written in the array records.
+_DTYPE_STR_CACHE = {}
+
+
+def _get_dtype(dtype_str):
+    try:
+        return _DTYPE_CACHE[dtype_str]
+    except KeyError:
+        dtype = _DTYPE_CACHE[dtype_str] = numpy.dtype(dtype_str)
+        return dtype
+
+
+_writev = getattr(os, 'writev', None)  # Not available on Windows.
+_posix_fallocate = getattr(os, 'posix_fallocate', None)  # Only available on Unix.
+
+# Errors from posix_fallocate for which the file is just truncated to the size (as preallocating
+# isn't supported).
+_FALLOCATE_NOT_SUPPORTED_ERRNOS = frozenset(
+    getattr(errno, name) for name in ('EOPNOTSUPP', 'ENOTSUP', 'EINVAL') if hasattr(errno, name))
+
+
+def _write_all(fileno, buffers):
+    '''
+    Writes all the given buffers to the given file descriptor (with a single os.writev call
+    if available, retrying any remaining bytes if it's a short write).
+    '''
+    if _writev is not None:
+        written = _writev(fileno, buffers)
+    else:
+        written = 0
+
+    for buf in buffers:
+        buf_len = len(buf)
+        if written >= buf_len:
+            written -= buf_len
+            continue
+
+        view = memoryview(buf)[written:]
+        written = 0
+        while len(view):
+            view = view[os.write(fileno, view):]
+
+
+def _write_file_atomically(filename, buffers):
+    '''
+    Writes the given buffers to a temporary file which then replaces the given file (so, readers
+    never see it partially written).
+    '''
+    tmp_filename = filename + '.tmp'
+    with file(tmp_filename, 'wb') as stream:
+        for buf in buffers:
+            stream.write(buf)
+
+    if PY3_ONWARDS:
+        os.replace(tmp_filename, filename)
+    else:
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp_filename, filename)
+
+
+# (dtype representation, shape, order) -> end of the array record header (from the number of
+# bytes of the data onwards), which is the same for all the arrays with the same dtype, shape and
+# order (i.e.: it's usual to write many arrays with the same dtype and shape).
+_ARRAY_HEADER_TAIL_CACHE = {}
+_ARRAY_HEADER_TAIL_CACHE_MAX_SIZE = 1024
+
+
+def _encode_array_header_tail(nbytes, dtype_bytes, shape, order):
+    '''
+    :return bytes:
+        The end of the header of an array record (see _encode_array_header).
+    '''
+    pack_into = STRUCT_UNSIGNED_LONG.pack_into
+    size_len = STRUCT_UNSIGNED_LONG.size
+    len_dtype = len(dtype_bytes)
+
+    tail = bytearray(
+        size_len + 1 +  # nbytes
+        size_len + len_dtype + 1 +
+        size_len + size_len * len(shape) + 1 +  # shape
+        2  # order
+    )
+
+    # long (number of bytes of the data)
+    pack_into(tail, 0, nbytes)
+    offset = size_len
+    tail[offset] = 58  # ':'
+    offset += 1
+
+    # long with dtypes representation len and dtypes representation
+    pack_into(tail, offset, len_dtype)
+    offset += size_len
+    tail[offset:offset + len_dtype] = dtype_bytes
+    offset += len_dtype
+    tail[offset] = 58
+    offset += 1
+
+    # long with dimension and actual size in each dimension
+    ndim = len(shape)
+    if ndim < len(SHAPE_STRUCTS):
+        shape_struct = SHAPE_STRUCTS[ndim]
+    else:
+        shape_struct = struct.Struct('<%dL' % (ndim + 1))
+    shape_struct.pack_into(tail, offset, ndim, *shape)
+    offset += shape_struct.size
+
+    # C or Fortran order
+    tail[offset:offset + 2] = b'::'
+    tail[offset + 2:offset + 3] = order
+    return bytes(tail)
+
+
+def _encode_array_header(group_path_bytes, array_name_bytes, nbytes, dtype_bytes, shape, order):
+    '''
+    Provides the header of an array record (written before the array data in the binary file
+    and as the array record in the log file).
+
+    Note: this is called for each array written, so, it's kept as lean as possible (no helper
+    calls in the common case and a single buffer preallocated with the final size which is
+    packed in place -- the part which only depends on the dtype, shape and order is cached).
+
+    :return bytearray:
+    '''
+    key = (dtype_bytes, shape, order)
+    try:
+        tail = _ARRAY_HEADER_TAIL_CACHE[key]
+    except KeyError:
+        tail = _encode_array_header_tail(nbytes, dtype_bytes, shape, order)
+        if len(_ARRAY_HEADER_TAIL_CACHE) >= _ARRAY_HEADER_TAIL_CACHE_MAX_SIZE:
+            _ARRAY_HEADER_TAIL_CACHE.clear()
+        _ARRAY_HEADER_TAIL_CACHE[key] = tail
+
+    pack_into = STRUCT_UNSIGNED_LONG.pack_into
+    size_len = STRUCT_UNSIGNED_LONG.size
+    len_group = len(group_path_bytes)
+    len_name = len(array_name_bytes)
+
+    header = bytearray(
+        4 +  # ARR:
+        size_len + len_group + 1 +
+        size_len + len_name + 1 +
+        len(tail)
+    )
+    header[0:4] = b'ARR:'
+
+    # long with group path size and group path
+    pack_into(header, 4, len_group)
+    offset = 4 + size_len
+    header[offset:offset + len_group] = group_path_bytes
+    offset += len_group
+    header[offset] = 58  # ':'
+    offset += 1
+
+    # long with array name size and array name
+    pack_into(header, offset, len_name)
+    offset += size_len
+    header[offset:offset + len_name] = array_name_bytes
+    offset += len_name
+    header[offset] = 58
+    offset += 1
+
+    # number of bytes, dtype, shape and order
+    header[offset:] = tail
+    return header
+
+
+class _IncompleteLogRecord(Exception):
+    pass
+
+
+class _LogRecordsReader(object):
+    '''
+    Helper to read the fields of the records in the contents of a log file.
+    '''
+
+    def __init__(self, log_bytes, offset):
+        self.log_bytes = log_bytes
+        self.offset = offset
+
+    def at_end(self):
+        return self.offset >= len(self.log_bytes)
+
+    def startswith(self, prefix):
+        return self.log_bytes.startswith(prefix, self.offset)
+
+    def read(self, size):
+        end = self.offset + size
+        if end > len(self.log_bytes):
+            raise _IncompleteLogRecord()
+        ret = self.log_bytes[self.offset:end]
+        self.offset = end
+        return ret
+
+    def expect(self, expected):
+        if self.read(len(expected)) != expected:
+            raise IOError(
+                'Unexpected contents in log file at: %s. Log file seems corrupted.' % (self.offset,))
+
+    def read_struct(self, struct_instance):
+        return struct_instance.unpack(self.read(struct_instance.size))[0]
+
+    def read_unsigned_long(self):
+        return self.read_struct(STRUCT_UNSIGNED_LONG)
+
+    def read_sized_field(self):
+        ret = self.read(self.read_unsigned_long())
+        self.expect(b':')
+        return ret
 
 
 class _Array(object):
 
-    def __init__(self, hbinseek, array_name, array_record_offset, data_offset, dtype, shape, order, len_in_bytes):
+    # Files may have lots of arrays, so, use slots to save memory.
+    __slots__ = (
+        '_hbinseek',
+        '_name',
+        '_record_offset',
+        '_data_offset',
+        '_dtype',
+        '_shape',
+        '_order',
+        '_bytes_len',
+        '_compression',
+        '_compressed_bytes_len',
+    )
+
+    def __init__(self, hbinseek, array_name, array_record_offset, data_offset, dtype, shape, order, len_in_bytes, compression=None, compressed_bytes_len=None):
         if dtype.hasobject:
             raise RuntimeError('Cannot deal with custom Python types.')
         self._hbinseek = hbinseek
@@ -88,8 +408,11 @@ class _Array(object):
         self._shape = shape
         self._order = order
         self._bytes_len = len_in_bytes
+        self._compression = compression
+        self._compressed_bytes_len = compressed_bytes_len
 
         assert order in ('F', 'C')
+        assert compression in VALID_COMPRESSIONS
 
     @property
     def name(self):
@@ -119,21 +442,30 @@ class _Array(object):
     def bytes_len(self):
         return self._bytes_len
 
+    @property
+    def compression(self):
+        return self._compression
+
     @classmethod
     def _from_json(cls, hbinseek, json):
-        return _Array(
-            hbinseek,
-            json['name'],
-            json['record_offset'],
-            json['data_offset'],
-            numpy.dtype(json['dtype']),
-            json['shape'],
-            json['order'],
-            json['data_bytes_len'],
-        )
+        # Note: __init__ is skipped as the contents were already validated when written.
+        array = object.__new__(cls)
+        array._hbinseek = hbinseek
+        array._name = json['name']
+        array._record_offset = json['record_offset']
+        array._data_offset = json['data_offset']
+        array._dtype = _get_dtype(json['dtype'])
+        # Note: a list when loaded from the json.
+        array._shape = tuple(json['shape'])
+        array._order = json['order']
+        array._bytes_len = json['data_bytes_len']
+        # Only available for compressed arrays.
+        array._compression = json.get('compression')
+        array._compressed_bytes_len = json.get('compressed_bytes_len')
+        return array
 
     def _to_json(self):
-        return {
+        ret = {
             'name': self._name,
             'record_offset': self._record_offset,
             'data_offset': self._data_offset,
@@ -142,45 +474,134 @@ class _Array(object):
             'order': self._order,
             'shape': self._shape,
         }
+        if self._compression is not None:
+            ret['compression'] = self._compression
+            ret['compressed_bytes_len'] = self._compressed_bytes_len
+        return ret
+
+    def _decompress(self, max_length=None):
+        '''
+        :param int max_length:
+            If given, only up to this number of bytes is decompressed.
+
+        :return bytes:
+            The (uncompressed) data of a compressed array.
+        '''
+        data_end = self._data_offset + self._compressed_bytes_len
+        binary_mmap = self._hbinseek._get_binary_mmap(data_end)
+        if binary_mmap is None:
+            raise IOError(
+                'Unable to read required bytes. Binary file seems corrupted.')
+
+        compressed = memoryview(binary_mmap)[self._data_offset:data_end]
+        try:
+            if max_length is None:
+                return zlib.decompress(compressed)
+            elif max_length == 0:
+                return b''
+            return zlib.decompressobj().decompress(compressed, max_length)
+        finally:
+            compressed.release()
 
     def read_numpy(self):
+        '''
+        :return numpy.ndarray:
+            A read-only array with the data (a view over the memory-mapped file, so, no copy is
+            done -- use `array.copy()` if a writable array is needed).
+        '''
         if self._hbinseek.mode != 'r':
             raise RuntimeError('May only read an array in read mode.')
 
-        binary_stream = self._hbinseek._binary_stream
-        binary_stream.seek(self._data_offset)
-        bytes_read = binary_stream.read(self._bytes_len)
-        if len(bytes_read) != self._bytes_len:
+        if self._compression is not None:
+            buf = self._decompress()
+            offset = 0
+        else:
+            buf = self._hbinseek._get_binary_mmap(
+                self._data_offset + self._bytes_len)
+            if buf is None:
+                raise IOError(
+                    'Unable to read required bytes. Binary file seems corrupted.')
+            offset = self._data_offset
+
+        # Note: no copy is done here: the returned array is a read-only view over the
+        # memory-mapped file (so, the OS pages the data in on demand) and the order is
+        # given directly to the ndarray (so, no reshape/transpose is needed).
+        return numpy.ndarray(
+            self._shape,
+            dtype=self._dtype,
+            buffer=buf,
+            offset=offset,
+            order=self._order)
+
+    def read_chunk(self, start, count):
+        '''
+        Reads only a part of the array (without copying it: the returned array is a read-only
+        view over the memory-mapped file -- for compressed arrays, only the data up to the
+        end of the chunk is decompressed).
+
+        :param int start:
+            The index of the first element to read (elements are indexed in the order they're
+            stored, i.e.: in the array order).
+
+        :param int count:
+            The number of elements to read.
+
+        :return numpy.ndarray:
+            A 1-dimensional array with the elements read.
+        '''
+        if self._hbinseek.mode != 'r':
+            raise RuntimeError('May only read an array in read mode.')
+
+        size = int(numpy.prod(self._shape))
+        if start < 0 or count < 0 or start + count > size:
+            raise ValueError(
+                'Unable to read %s elements from %s (array size: %s).' % (count, start, size))
+
+        itemsize = self._dtype.itemsize
+        if self._compression is not None:
+            data = self._decompress((start + count) * itemsize)
+            return numpy.frombuffer(
+                data, dtype=self._dtype, count=count, offset=start * itemsize)
+
+        offset = self._data_offset + start * itemsize
+        binary_mmap = self._hbinseek._get_binary_mmap(offset + count * itemsize)
+        if binary_mmap is None:
             raise IOError(
                 'Unable to read required bytes. Binary file seems corrupted.')
 
-        # https://github.com/numpy/numpy/blob/master/numpy/lib/format.py
-        # has a better way of doing things, but let's leave it as is for now.
-        array = numpy.fromstring(bytes_read, dtype=self._dtype)
-        if self._order == 'F':
-            array.shape = self._shape[::-1]
-            array = array.transpose()
-        else:
-            array.shape = self._shape
-
-        return array
+        return numpy.frombuffer(
+            binary_mmap, dtype=self._dtype, count=count, offset=offset)
 
 
 class _Group(object):
 
+    __slots__ = (
+        '_hbinseek',
+        '_name',
+        '_attrs',
+        '_arrays',
+        '_children_groups',
+        '_children_json',
+        '_parent',
+        '_path',
+        '_path_bytes',
+    )
+
     def __init__(self, parent, hbinseek, group_name, group_path):
         self._hbinseek = hbinseek
         self._name = group_name
         self._attrs = {}
         self._arrays = {}
         self._children_groups = {}
-        if parent is None:
-            self._parent = lambda: None
-        else:
-            self._parent = weakref.ref(parent)
+        # When loaded from the metadata, the json of the children is only loaded on demand.
+        self._children_json = None
+        # Note: not a weak reference (a group is only alive while its file is alive anyway).
+        self._parent = parent
         if '//' in group_path:
             raise RuntimeError('Invalid group path: %s' % (group_path,))
         self._path = group_path
+        # Encoded only once as it's written in every record related to the group.
+        self._path_bytes = group_path.encode('utf-8')
         if parent is not None:
             parent._children_groups[group_name] = self
 
@@ -192,22 +613,44 @@ class _Group(object):
     def name(self):
         return self._name
 
-    def create_array(self, array_name, data):
+    def create_array(self, array_name, data, compression=None):
         '''
         :param text_type array_name:
+
+        :param text_type compression:
+            One of VALID_COMPRESSIONS: if given the data is saved compressed (reading it back
+            then requires a copy to decompress it).
         '''
-        array = self._hbinseek._write_array(self._name, array_name, data)
+        array = self._hbinseek._write_array(self, array_name, data, compression)
         self._arrays[array_name] = array
 
     def get_array(self, array_name):
-        return self._arrays[array_name]
+        array = self._arrays[array_name]
+        if array.__class__ is dict:
+            # Still the json loaded from the metadata (arrays are only created when reached).
+            array = self._arrays[array_name] = _Array._from_json(self._hbinseek, array)
+        return array
 
     def set_attr(self, attr_name, value):
         assert isinstance(attr_name, text_type)
-        if not isinstance(value, VALID_ATTR_TYPES):
-            raise ValueError('Unexpected type for %s: %s' %
-                             (attr_name, type(value),))
-        self._hbinseek._write_set_attr(self._name, attr_name, value)
+        # Checking the exact type first is faster (isinstance is only needed for subclasses).
+        if type(value) not in _VALID_ATTR_TYPES_SET:
+            for valid_type in VALID_ATTR_TYPES:
+                if isinstance(value, valid_type):
+                    # Subclasses (i.e.: numpy.float64, IntEnum) are converted to the builtin type
+                    # (so that it's read back the same from the log, the json or the metadata
+                    # cache -- marshal doesn't handle subclasses properly).
+                    value = valid_type(value)
+                    break
+            else:
+                raise ValueError('Unexpected type for %s: %s' %
+                                 (attr_name, type(value),))
+
+        if value.__class__ in integer_types and not MIN_LONG_LONG <= value <= MAX_LONG_LONG:
+            # If this limit is reached, we may need to create a different type
+            raise ValueError('Unable to save %s: %s (integers must fit in a signed 64-bit long).' %
+                             (attr_name, value))
+        self._hbinseek._write_set_attr(self, attr_name, value)
         self._attrs[attr_name] = value
 
     def list_attrs(self):
@@ -233,6 +676,7 @@ class _Group(object):
         return self._hbinseek.create_group(full_path)
 
     def list_groups(self):
+        self._load_children()
         if PY3_ONWARDS:
             return list(self._children_groups.keys())
         else:
@@ -241,30 +685,79 @@ class _Group(object):
     #----------------------------------------------------------------------------- Group private API
 
     def _to_json(self):
-        ret = {
-            "children": [group._to_json() for group in self._children_groups.values()],
+        # Iterative walk (so, the nesting isn't limited by the recursion limit and there's no
+        # call overhead per level).
+        ret = self._to_json_node()
+        groups_and_nodes = [(self, ret)]
+        while groups_and_nodes:
+            group, node = groups_and_nodes.pop()
+            children_groups = list(group._children_groups.values())
+            node['children'] = children = [
+                child._to_json_node() for child in children_groups]
+            groups_and_nodes.extend(zip(children_groups, children))
+
+        return ret
+
+    def _to_json_node(self):
+        '''
+        :return dict:
+            The json for this group without the children (filled in by _to_json).
+        '''
+        return {
+            "children": None,
             "name": self._name,
             "attrs": self._attrs,
-            "arrays": [array._to_json() for array in self._arrays.values()]
+            "arrays": [
+                array if array.__class__ is dict else array._to_json()
+                for array in self._arrays.values()]
         }
 
-        return ret
-
     def _from_json(self, json):
-        children = json['children']
         self._name = json['name']
         self._attrs = json['attrs']
-        for array in json['arrays']:
-            self._arrays[array['name']] = _Array._from_json(
-                self._hbinseek, array)
-        for child in children:
-            group = self.create_group(child['name'])
-            group._from_json(child)
+        # Note: the json of the arrays is kept as is (the actual _Array is created lazily in
+        # get_array).
+        self._arrays = {array['name']: array for array in json['arrays']}
+        self._children_json = json['children']
+
+    def _load_children(self):
+        if self._children_json is None:
+            return
+
+        with self._hbinseek._load_lock:
+            children = self._children_json
+            if children is None:
+                return  # Loaded by another thread meanwhile.
+
+            # Children are created directly with their final path (without going through
+            # create_group, which would walk the full path for each child).
+            hbinseek = self._hbinseek
+            all_groups = hbinseek._all_groups
+            children_groups = self._children_groups
+            if self._path.endswith('/'):
+                path_prefix = self._path
+            else:
+                path_prefix = self._path + '/'
+
+            for child in children:
+                group = object.__new__(_Group)
+                group._hbinseek = hbinseek
+                group._parent = self
+                group._path = path = path_prefix + child['name']
+                group._path_bytes = None  # Only used when writing.
+                group._children_groups = {}
+                group._from_json(child)
+
+                children_groups[group._name] = group
+                all_groups[path] = group
+
+            # Only cleared when done (other threads check it without holding the lock).
+            self._children_json = None
 
 
 class _HBinseek(object):
 
-    def __init__(self, filename, mode='r', binary_data_filename=None, log_filename=None, autoflush=True, write_metadata=True):
+    def __init__(self, filename, mode='r', binary_data_filename=None, log_filename=None, autoflush=True, write_metadata=True, preload=False, compact_threshold=DEFAULT_COMPACT_THRESHOLD, background_writes=False, preallocate_bytes=None, use_metadata_cache=True):
         '''
         :param text_type mode:
             r = read-only (no write)
@@ -273,8 +766,33 @@ class _HBinseek(object):
         :param bool write_metadata:
             Whether to write the metadata (only applicable when mode == 'w') -- otherwise it has
             to be reconstructed from the log file.
+
+        :param bool preload:
+            Whether all the metadata should be loaded when the file is opened (only applicable
+            when mode == 'r') -- otherwise it's only loaded when first accessed and groups are
+            loaded as they're reached.
+
+        :param int compact_threshold:
+            The number of bytes written to the log after which the metadata is rewritten (only
+            applicable when mode == 'w' and write_metadata is True). Records in the log after
+            the last metadata written are replayed when the file is read.
+
+        :param bool background_writes:
+            Whether records should be written by a background thread (only applicable when
+            mode == 'w'), so that creating arrays doesn't block on I/O (the data of the array is
+            copied in this case). flush() and close() wait for the pending writes.
+
+        :param int preallocate_bytes:
+            If given, the space for this number of bytes is allocated for the binary file when
+            it's opened (only applicable when mode == 'w'), so that the filesystem doesn't have
+            to allocate it as arrays are appended. The space not used is released on close().
+
+        :param bool use_metadata_cache:
+            Whether the metadata cache (the .hmeta file written along with the metadata) may be
+            loaded (only applicable when mode == 'r'). It's a marshal dump, so, it's only safe to
+            load it if it's trusted -- it should be False to read untrusted files (in which case
+            only the json metadata is loaded).
         '''
-        import os
         assert filename.__class__ == text_type
         assert mode.__class__ == text_type
 
@@ -302,35 +820,122 @@ class _HBinseek(object):
 
         self._mode = mode
 
-        if mode == 'r':
-            if not os.path.exists(filename) and not os.path.exists(log_filename):
-                raise OSError(
-                    'Unable to open for read file which does not exist: %s' % (filename,))
+        background_writes = background_writes and mode == 'w'
+        if mode == 'w' and (autoflush or background_writes):
+            # Each record would be flushed right after being written (or is written from the
+            # background thread), so, streams are unbuffered and each record is written with a
+            # single (gathered) write.
+            buffering = 0
+        elif mode == 'w':
+            buffering = WRITE_BUFFER_SIZE
+        else:
+            buffering = -1
 
         self._all_groups = {}
         self._root_group = _Group(None, self, '/', '/')
-        self._binary_stream = file(binary_data_filename, mode + 'b')
-        self._log_stream = file(log_filename, mode + 'b')
+
+        metadata_cache_filename = os.path.splitext(filename)[0] + '.hmeta'
+        assert metadata_cache_filename not in (filename, binary_data_filename, log_filename)
+        if mode == 'w':
+            # The metadata of a previous session must be removed before the log is recreated
+            # (it doesn't match the new log -- while it's not rewritten, readers restore
+            # everything from the log).
+            for metadata_filename in (filename, metadata_cache_filename):
+                try:
+                    os.remove(metadata_filename)
+                except (IOError, OSError) as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+        # Note: files are just opened (without checking whether they exist first) to avoid
+        # additional syscalls (there's always a log file when there's anything to be read).
+        try:
+            # Note: when autoflush is off the log records are buffered in _write_buffers (so
+            # that they're only written after the binary data they refer to).
+            self._log_stream = file(log_filename, mode + 'b', 0 if mode == 'w' else buffering)
+        except (IOError, OSError) as e:
+            if mode == 'r' and e.errno == errno.ENOENT:
+                raise OSError(
+                    'Unable to open for read file which does not exist: %s' % (filename,))
+            raise
+        try:
+            self._binary_stream = file(binary_data_filename, mode + 'b', buffering)
+        except:
+            self._log_stream.close()
+            raise
+        self._binary_mmap = None
         self._autoflush = autoflush
         self._write_metadata = write_metadata
         self._metadata_filename = filename
-        self._loaded_info = False
+        self._metadata_cache_filename = metadata_cache_filename
+        # In write mode there's nothing to load (the metadata is created from scratch).
+        self._loaded_info = mode == 'w'
+        # Held when loading the metadata/groups lazily (so that different threads can read
+        # the same file -- groups already loaded are accessed without it).
+        self._load_lock = threading.RLock()
+        self._load_error = None
         self._dirty = False
-
-        if self._mode == 'r':
-            self._load_metadata()
+        self._closed = False
+        self._compact_threshold = compact_threshold
+        # Note: the offsets are tracked (and not gotten from the streams with tell()) as a
+        # tell() is a syscall and the data may still be pending to be written by the writer
+        # thread.
+        self._log_offset = 0
+        self._metadata_log_offset = 0
+        self._binary_offset = 0
+        self._pending_log_buffers = []
+        self._pending_log_len = 0
+        self._preallocate_bytes = preallocate_bytes if mode == 'w' else None
+        self._use_metadata_cache = use_metadata_cache
+
+        self._write_queue = None
+        self._writer_thread = None
+        self._writer_error = None
+        if background_writes:
+            self._write_queue = queue.Queue(maxsize=1024)
+            self._writer_thread = threading.Thread(target=self._writer_loop)
+            self._writer_thread.daemon = True
+            self._writer_thread.start()
+
+        if self._mode == 'r' and preload:
+            self._load_all_groups()
 
         if self._mode == 'w':
             # Header: filetype and version
-            self._binary_stream.write(b'%BINSEEK v001\n')
-            self._log_stream.write(b'%BINSEEKLOG v001\n')
-
-            if autoflush:
-                self._binary_stream.flush()
-                self._log_stream.flush()
-            else:
+            self._write_buffers(self._binary_stream, (BINARY_HEADER,))
+            self._write_buffers(self._log_stream, (LOG_HEADER,))
+            self._binary_offset = len(BINARY_HEADER)
+            self._log_offset = self._metadata_log_offset = len(LOG_HEADER)
+
+            # Note: only done if it's bigger than what's already written (the header) as
+            # ftruncate would otherwise shrink the file.
+            if preallocate_bytes and preallocate_bytes > self._binary_offset:
+                try:
+                    self._preallocate_binary(preallocate_bytes)
+                except:
+                    # Don't leave the streams (and the writer thread) open.
+                    self._write_metadata = False
+                    self.close()
+                    raise
+
+            if not autoflush:
                 self._dirty = True
 
+    def _preallocate_binary(self, size):
+        fileno = self._binary_stream.fileno()
+        if _posix_fallocate is not None:
+            try:
+                _posix_fallocate(fileno, 0, size)
+                return
+            except OSError as e:
+                # Any other error (i.e.: ENOSPC) must be reported right away.
+                if e.errno not in _FALLOCATE_NOT_SUPPORTED_ERRNOS:
+                    raise
+                # i.e.: Not supported by the filesystem.
+
+        # Note: the stream position isn't changed (writes still go right after the header).
+        os.ftruncate(fileno, size)
+
     @property
     def filename(self):
         return self._filename
@@ -343,6 +948,10 @@ class _HBinseek(object):
     def binary_data_filename(self):
         return self._binary_data_filename
 
+    @property
+    def metadata_cache_filename(self):
+        return self._metadata_cache_filename
+
     @property
     def write_metadata(self):
         return self._write_metadata
@@ -356,30 +965,257 @@ class _HBinseek(object):
         return self._mode
 
     def _load_metadata(self):
-        import json
-        import os
-        import io
-        if not self._loaded_info:
-            if os.path.exists(self._metadata_filename):
-                with io.open(self._metadata_filename, 'r', encoding='utf-8') as f:
-                    loaded_json = json.load(f)
-                    self._root_group._from_json(loaded_json)
+        if self._loaded_info:
+            return
+
+        with self._load_lock:
+            if self._loaded_info:
+                return  # Loaded by another thread meanwhile.
+
+            if self._load_error is not None:
+                # The groups were only partially restored (so, they may not be used).
+                raise self._load_error
+
+            loaded_json = None
+            if self._use_metadata_cache:
+                loaded_json = self._load_metadata_cache()
+            if loaded_json is None:
+                try:
+                    metadata_stream = file(self._metadata_filename, 'rb')
+                except (IOError, OSError) as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    # No metadata: everything is restored from the log.
+                else:
+                    # Read and decoded at once (instead of going through a text stream).
+                    with metadata_stream:
+                        loaded_json = json.loads(metadata_stream.read().decode('utf-8'))
+
+            log_offset = len(LOG_HEADER)
+            if loaded_json is not None:
+                self._root_group._from_json(loaded_json)
+                log_offset = loaded_json.get('log_offset', log_offset)
+
+            try:
+                # Anything written after the metadata is restored from the log file.
+                self._replay_log(log_offset, loaded_json is not None)
+            except Exception as e:
+                self._load_error = e
+                raise
 
+            # Only set when done (other threads check it without holding the lock).
             self._loaded_info = True
 
+    def _replay_log(self, log_offset, metadata_loaded):
+        if log_offset == len(LOG_HEADER):
+            self._log_stream.seek(0)
+            header = self._log_stream.read(len(LOG_HEADER))
+            if header != LOG_HEADER:
+                if header == LOG_HEADER_V001 and not metadata_loaded:
+                    raise IOError(
+                        'Unable to restore the metadata from a log file in an old format (v001): %s' % (
+                            self._log_filename,))
+                # Empty (i.e.: still not flushed), in the old format (and the metadata was
+                # loaded) or not really a log file.
+                return
+        else:
+            self._log_stream.seek(log_offset)
+
+        reader = _LogRecordsReader(self._log_stream.read(), 0)
+
+        # Only complete records are restored (the log may still be being written).
+        while not reader.at_end():
+            try:
+                self._replay_log_record(reader)
+            except _IncompleteLogRecord:
+                break
+
+    def _replay_log_record(self, reader):
+        '''
+        Reads a record from the log and applies it to the groups (only done after the record is
+        completely read).
+        '''
+        record_start = reader.offset
+        if reader.startswith(b'GRP:'):
+            reader.read(4)
+            group_path = reader.read_sized_field().decode('utf-8')
+            reader.expect(b'\n')
+            self._get_or_create_group(group_path)
+
+        elif reader.startswith(b'ATTR:'):
+            reader.read(5)
+            group_path = reader.read_sized_field().decode('utf-8')
+            attr_name = reader.read_sized_field().decode('utf-8')
+            value_type = reader.read(5)
+            if value_type == b'text:':
+                attr_value = reader.read(reader.read_unsigned_long()).decode('utf-8')
+            elif value_type == b'byte:':
+                attr_value = reader.read(reader.read_unsigned_long())
+            elif value_type == b'doub:':
+                attr_value = reader.read_struct(STRUCT_DOUBLE)
+            elif value_type == b'long:':
+                attr_value = reader.read_struct(STRUCT_LONG_LONG)
+            elif value_type == b'bool:':
+                attr_value = reader.read_struct(STRUCT_BOOL)
+            else:
+                raise IOError(
+                    'Unexpected attribute type in log file: %s. Log file seems corrupted.' % (value_type,))
+            reader.expect(b'\n')
+            self._get_or_create_group(group_path)._attrs[attr_name] = attr_value
+
+        elif reader.startswith(b'ARR:') or reader.startswith(b'ARRZ:'):
+            compressed = reader.startswith(b'ARRZ:')
+            reader.read(5 if compressed else 4)
+            group_path = reader.read_sized_field().decode('utf-8')
+            array_name = reader.read_sized_field().decode('utf-8')
+            nbytes = reader.read_unsigned_long()
+            reader.expect(b':')
+            dtype = _get_dtype(reader.read_sized_field().decode('ascii'))
+            ndim = reader.read_unsigned_long()
+            shape = tuple(reader.read_unsigned_long() for _i in range(ndim))
+            reader.expect(b'::')
+            order = reader.read(1).decode('ascii')
+            compression = None
+            compressed_bytes_len = None
+            if compressed:
+                reader.expect(b':')
+                compression = reader.read_sized_field().decode('ascii')
+                compressed_bytes_len = reader.read_unsigned_long()
+            # The same header is written in the binary file (before the data).
+            header_len = reader.offset - record_start
+            record_offset = reader.read_unsigned_long()
+            reader.expect(b'\n')
+            self._get_or_create_group(group_path)._arrays[array_name] = _Array(
+                self,
+                array_name,
+                record_offset,
+                record_offset + header_len,
+                dtype,
+                shape,
+                order,
+                nbytes,
+                compression,
+                compressed_bytes_len,
+            )
+
+        else:
+            remaining = reader.log_bytes[record_start:record_start + 5]
+            if any(record_type.startswith(remaining) for record_type in (b'GRP:', b'ATTR:', b'ARR:', b'ARRZ:')):
+                raise _IncompleteLogRecord()
+            raise IOError(
+                'Unexpected record in log file at: %s. Log file seems corrupted.' % (record_start,))
+
+    def _load_metadata_cache(self):
+        '''
+        :return dict:
+            The metadata loaded from the metadata cache or None if it's not available (or is
+            older than the json metadata or was written by a different Python version or
+            doesn't have the expected contents).
+
+        Note: the cache is trusted (marshal isn't safe against malicious data).
+        '''
+        try:
+            if os.path.getmtime(self._metadata_cache_filename) < os.path.getmtime(self._metadata_filename):
+                return None
+            cache_stream = file(self._metadata_cache_filename, 'rb')
+        except (IOError, OSError):
+            return None
+
+        with cache_stream:
+            header = cache_stream.readline()
+            try:
+                if header == METADATA_CACHE_HEADER:
+                    loaded = marshal.load(cache_stream)
+                elif header == METADATA_CACHE_ZLIB_HEADER:
+                    loaded = marshal.loads(zlib.decompress(cache_stream.read()))
+                else:
+                    return None
+            except (EOFError, ValueError, TypeError, zlib.error):
+                # i.e.: incomplete (still being written).
+                return None
+
+        # Checked as anything could be loaded from a malformed dump (the json is used then).
+        if (
+                loaded.__class__ is not dict or
+                loaded.get('name').__class__ is not text_type or
+                loaded.get('attrs').__class__ is not dict or
+                loaded.get('arrays').__class__ is not list or
+                loaded.get('children').__class__ is not list or
+                loaded.get('log_offset').__class__ not in integer_types):
+            return None
+        return loaded
+
+    def _load_all_groups(self):
+        self._load_metadata()
+        groups = [self._root_group]
+        while groups:
+            group = groups.pop()
+            group._load_children()
+            groups.extend(group._children_groups.values())
+
+    def _get_binary_mmap(self, required_len):
+        '''
+        :return mmap.mmap:
+            A read-only memory-map of the binary file with at least `required_len` bytes (it's
+            remapped if the file grew since it was last mapped) or None if the file doesn't have
+            that many bytes.
+        '''
+        binary_mmap = self._binary_mmap
+        if binary_mmap is None or len(binary_mmap) < required_len:
+            fileno = self._binary_stream.fileno()
+            if os.fstat(fileno).st_size < required_len:
+                return None
+            binary_mmap = self._binary_mmap = mmap.mmap(
+                fileno, 0, access=mmap.ACCESS_READ)
+        return binary_mmap
+
     def list_groups(self):
+        self._load_metadata()
         return self._root_group.list_groups()
 
     def all_groups(self):
+        self._load_all_groups()
         if PY3_ONWARDS:
             return list(self._all_groups.values())
         else:
             return self._all_groups.values()
 
+    def _find_group(self, group_path):
+        '''
+        :return _Group:
+            The group in the given path or None if it doesn't exist.
+        '''
+        self._load_metadata()
+        group = self._all_groups.get(group_path)
+        if group is not None:
+            return group
+
+        # It may not be loaded yet: load the groups in its path.
+        group = self._root_group
+        for group_part in group_path[1:].split('/'):
+            group._load_children()
+            group = group._children_groups.get(group_part)
+            if group is None:
+                return None
+        return group
+
     def __getitem__(self, group_path):
-        return self._all_groups[group_path]
+        group = self._find_group(group_path)
+        if group is None:
+            raise KeyError(group_path)
+        return group
+
+    def __contains__(self, group_path):
+        return self._find_group(group_path) is not None
+
+    def get_array(self, group_path, array_name):
+        group = self._find_group(group_path)
+        if group is None:
+            raise KeyError(group_path)
+        return group.get_array(array_name)
 
     def __len__(self):
+        self._load_all_groups()
         return len(self._all_groups)
 
     def _check_writable(self):
@@ -387,11 +1223,11 @@ class _HBinseek(object):
             raise RuntimeError(
                 'Unable to write when not in write mode. Current mode: %s' % (self._mode,))
 
-    def create_array(self, group_name, array_name, data):
+    def create_array(self, group_name, array_name, data, compression=None):
         assert array_name.__class__ == text_type
         assert group_name.__class__ == text_type
 
-        self.create_group(group_name).create_array(array_name, data)
+        self.create_group(group_name).create_array(array_name, data, compression)
 
     def create_group(self, group_name):
         assert group_name.__class__ == text_type
@@ -399,6 +1235,23 @@ class _HBinseek(object):
             raise ValueError('Group name must be given.')
 
         assert group_name.startswith('/')
+
+        # The groups from the metadata must be reached (and not recreated empty).
+        self._load_metadata()
+        return self._get_or_create_group(group_name)
+
+    def _get_or_create_group(self, group_name):
+        '''
+        Provides the group in the given path (creating it and the groups up to it if needed).
+
+        Note: also used when replaying the log (when the metadata isn't completely loaded yet).
+        '''
+        # Fast path: the group already exists (i.e.: it's usual to create many arrays in the
+        # same group), so, a single lookup with the full path is enough.
+        group = self._all_groups.get(group_name)
+        if group is not None:
+            return group
+
         group_name = group_name[1:]
         full_path = '/'
         parent = self._root_group
@@ -407,137 +1260,285 @@ class _HBinseek(object):
             try:
                 group = self._all_groups[full_path]
             except KeyError:
-                group = self._all_groups.setdefault(
-                    full_path, _Group(parent, self, group_part, full_path))
+                # It may still have to be loaded from the metadata.
+                parent._load_children()
+                group = self._all_groups.get(full_path)
+                if group is None:
+                    group = self._all_groups[full_path] = _Group(
+                        parent, self, group_part, full_path)
+                    if self._mode == 'w':
+                        self._write_group(group)
 
             parent = group
             full_path += '/'
         return group
 
-    def _write_set_attr(self, group_name, attr_name, attr_value):
-        import struct
-        assert attr_name.__class__ == text_type
-        assert group_name.__class__ == text_type
+    def _write_buffers(self, stream, buffers):
+        '''
+        Writes the given buffers (in order) to the given stream.
 
-        to_log = []
-        to_log.append(b'ATTR:')
+        When autoflush is on the stream is unbuffered and all the buffers are written with a
+        single gathered write (if available in the platform). With background writes they're
+        just queued to be written by the writer thread. Otherwise they're written to the
+        buffered stream (big records skip its buffer and are written as if autoflush was on)
+        or, for the log, kept pending until the binary data is flushed.
+        '''
+        if self._write_queue is not None:
+            self._check_writer_error()
+            self._write_queue.put((stream, buffers))
+        elif self._autoflush:
+            _write_all(stream.fileno(), buffers)
+        elif stream is self._log_stream:
+            # The log can't be written before the binary data it refers to (readers must never
+            # see a record whose data isn't there), so, it's only written along with a flush of
+            # the binary stream.
+            self._pending_log_buffers.extend(buffers)
+            self._pending_log_len += sum(len(buf) for buf in buffers)
+            if self._pending_log_len >= WRITE_BUFFER_SIZE:
+                self._flush_pending_log()
+        elif sum(len(buf) for buf in buffers) > DIRECT_WRITE_THRESHOLD:
+            # What's already buffered must be written first to keep the order.
+            stream.flush()
+            _write_all(stream.fileno(), buffers)
+        else:
+            for buf in buffers:
+                stream.write(buf)
 
-        attr_name_bytes = attr_name.encode('utf-8')
-        group_name_bytes = group_name.encode('utf-8')
+    def _writer_loop(self):
+        '''
+        Writes the records queued by _write_buffers (in the writer thread) until a None is
+        queued.
 
-        # long with group name size and group size
-        to_log.append(struct.pack(PACK_UNSIGNED_LONG, len(group_name_bytes)))
-        to_log.append(group_name_bytes)
-        to_log.append(b':')
+        All the records available are written at each wakeup with a single gathered write per
+        stream (the binary stream is written first so that the log never refers to data not
+        written yet).
+        '''
+        write_queue = self._write_queue
+        binary_stream = self._binary_stream
+        finish = False
+        while not finish:
+            items = [write_queue.get()]
+            while len(items) < 64:
+                try:
+                    items.append(write_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            binary_buffers = []
+            log_buffers = []
+            for item in items:
+                if item is None:
+                    finish = True
+                    break
+                stream, buffers = item
+                if stream is binary_stream:
+                    binary_buffers.extend(buffers)
+                else:
+                    log_buffers.extend(buffers)
 
-        # long with array name size and array size
-        to_log.append(struct.pack(PACK_UNSIGNED_LONG, len(attr_name_bytes)))
-        to_log.append(attr_name_bytes)
-        to_log.append(b':')
+            try:
+                if self._writer_error is None:
+                    if binary_buffers:
+                        _write_all(binary_stream.fileno(), binary_buffers)
+                    if log_buffers:
+                        _write_all(self._log_stream.fileno(), log_buffers)
+            except Exception as e:
+                # Reported in the thread writing the records.
+                self._writer_error = e
+            finally:
+                for _item in items:
+                    write_queue.task_done()
+
+    def _check_writer_error(self):
+        error = self._writer_error
+        if error is not None:
+            raise IOError('Error writing in background: %s' % (error,))
+
+    def _flush_streams(self):
+        if self._write_queue is not None:
+            self._write_queue.join()
+            self._check_writer_error()
 
-        if attr_value.__class__ == text_type:
-            to_log.append(b'text:')
-            as_bytes = attr_value.encode('utf-8')
+        self._binary_stream.flush()
+        self._flush_pending_log()
+        self._log_stream.flush()
 
-            # If this limit is reached, we may need to create a different type
-            assert len(as_bytes) <= MAX_UNSIGNED_LONG
+    def _flush_pending_log(self):
+        if self._pending_log_buffers:
+            self._binary_stream.flush()
+            log_bytes = b''.join(self._pending_log_buffers)
+            del self._pending_log_buffers[:]
+            self._pending_log_len = 0
+            _write_all(self._log_stream.fileno(), (log_bytes,))
+
+    def _write_log_record(self, buffers):
+        # Note: checked before writing the new record because the previous record is only
+        # surely applied to the groups at this point.
+        if (
+                self._write_metadata and
+                self._log_offset - self._metadata_log_offset >= self._compact_threshold):
+            self._flush_metadata()
 
-            to_log.append(struct.pack(PACK_UNSIGNED_LONG, len(as_bytes)))
-            to_log.append(as_bytes)
+        self._write_buffers(self._log_stream, buffers)
+        self._log_offset += sum(len(buf) for buf in buffers)
 
-        elif attr_value.__class__ == bytes:
-            to_log.append(b'byte:')
+    def _write_group(self, group):
+        group_path_bytes = group._path_bytes
 
-            # If this limit is reached, we may need to create a different type
-            assert len(attr_value) <= MAX_UNSIGNED_LONG
+        to_log = bytearray(4 + _sized_field_len(group_path_bytes))  # GRP:
+        to_log[0:4] = b'GRP:'
+
+        # long with group path size and group path
+        _pack_sized_field_into(to_log, 4, group_path_bytes)
 
-            to_log.append(struct.pack(PACK_UNSIGNED_LONG, len(attr_value)))
-            to_log.append(attr_value)
+        # end record
+        self._write_log_record((to_log, b'\n'))
+
+    def _write_set_attr(self, group, attr_name, attr_value):
+        self._check_writable()
+
+        attr_name_bytes = attr_name.encode('utf-8')
+        group_path_bytes = group._path_bytes
+
+        value_bytes = None
+        value_struct = None
+        if attr_value.__class__ == text_type:
+            value_type = b'text:'
+            value_bytes = attr_value.encode('utf-8')
+
+        elif attr_value.__class__ == bytes:
+            value_type = b'byte:'
+            value_bytes = attr_value
+
+        elif attr_value.__class__ == bool:
+            value_type = b'bool:'
+            value_struct = STRUCT_BOOL
 
         elif isinstance(attr_value, float):
-            to_log.append(b'doub:')
-            to_log.append(struct.pack(PACK_DOUBLE, attr_value))
+            value_type = b'doub:'
+            value_struct = STRUCT_DOUBLE
 
-        elif not PY3_ONWARDS and isinstance(attr_value, (int, long)):
+        elif isinstance(attr_value, integer_types):
             # int or long is considered as long in the format
-            to_log.append(b'long:')
-            to_log.append(struct.pack(PACK_LONG_LONG, attr_value))
+            value_type = b'long:'
+            value_struct = STRUCT_LONG_LONG
+
+        else:
+            raise ValueError('Unexpected type for %s: %s' %
+                             (attr_name, type(attr_value),))
+
+        if value_bytes is not None:
+            # If this limit is reached, we may need to create a different type
+            assert len(value_bytes) <= MAX_UNSIGNED_LONG
+            value_len = STRUCT_UNSIGNED_LONG.size + len(value_bytes)
+        else:
+            value_len = value_struct.size
+
+        # The record is packed in place in a buffer preallocated with the final size.
+        to_log = bytearray(
+            5 +  # ATTR:
+            _sized_field_len(group_path_bytes) +
+            _sized_field_len(attr_name_bytes) +
+            len(value_type) +
+            value_len
+        )
+        to_log[0:5] = b'ATTR:'
+
+        # long with group name size and group name
+        offset = _pack_sized_field_into(to_log, 5, group_path_bytes)
+
+        # long with attr name size and attr name
+        offset = _pack_sized_field_into(to_log, offset, attr_name_bytes)
 
-    def _write_array(self, group_name, array_name, data):
-        import struct
+        to_log[offset:offset + len(value_type)] = value_type
+        offset += len(value_type)
+        if value_bytes is not None:
+            # long with value size and value
+            STRUCT_UNSIGNED_LONG.pack_into(to_log, offset, len(value_bytes))
+            offset += STRUCT_UNSIGNED_LONG.size
+            to_log[offset:] = value_bytes
+        else:
+            value_struct.pack_into(to_log, offset, attr_value)
+
+        # end record
+        self._write_log_record((to_log, b'\n'))
+
+    def _write_array(self, group, array_name, data, compression=None):
         self._check_writable()
 
         assert array_name.__class__ == text_type
-        assert group_name.__class__ == text_type
+        if compression not in VALID_COMPRESSIONS:
+            raise ValueError('Unexpected compression: %s (expected one of: %s).' % (
+                compression, VALID_COMPRESSIONS))
 
         array_name_bytes = array_name.encode('utf-8')
-        group_name_bytes = group_name.encode('utf-8')
 
-        # Internally always save in C order.
-        data_as_bytes = data.tobytes('C')
+        # The array memory is written as is (without a copy) when it's contiguous (for a
+        # Fortran-ordered array its transpose is C-contiguous and shares the same memory).
+        # Non-contiguous arrays are copied once to be saved in C order.
+        if data.flags.f_contiguous:
+            order = b'F'
+            contiguous_data = data.transpose()
+        else:
+            order = b'C'
+            contiguous_data = numpy.ascontiguousarray(data)
+        data_buffer = contiguous_data.reshape(-1).view(numpy.uint8)
+        nbytes = data.nbytes
 
         # If this limit is reached, we may need to create a different
         # representation (as we can't pack sizes with unsigned long).
-        assert len(data_as_bytes) <= MAX_UNSIGNED_LONG
-
-        binary_stream = self._binary_stream
-
-        curr_offset = binary_stream.tell()
+        assert nbytes <= MAX_UNSIGNED_LONG
 
-        to_log = []
-        to_log.append(b'ARR:')
+        compressed_bytes_len = None
+        if compression is not None:
+            data_buffer = zlib.compress(data_buffer, 1)
+            compressed_bytes_len = len(data_buffer)
 
-        # long with group name size and group size
-        to_log.append(struct.pack(PACK_UNSIGNED_LONG, len(group_name_bytes)))
-        to_log.append(group_name_bytes)
-        to_log.append(b':')
+        elif self._write_queue is not None:
+            # The data may be written only later on, so, it has to be copied (the array could
+            # be changed by the caller meanwhile).
+            data_buffer = data_buffer.copy()
 
-        # long with array name size and array size
-        to_log.append(struct.pack(PACK_UNSIGNED_LONG, len(array_name_bytes)))
-        to_log.append(array_name_bytes)
-        to_log.append(b':')
-
-        # long (number of bytes of the data)
-        to_log.append(struct.pack(PACK_UNSIGNED_LONG, len(data_as_bytes)))
-        to_log.append(b':')
+        binary_stream = self._binary_stream
 
-        # long with dtypes representation len and dtypes representation
-        dtype_bytes = data.dtype.str.encode('ascii')
-        to_log.append(struct.pack(PACK_UNSIGNED_LONG, len(dtype_bytes)))
-        to_log.append(dtype_bytes)
-        to_log.append(b':')
+        curr_offset = self._binary_offset
 
-        # long with dimension and actual size in each dimension
-        to_log.append(struct.pack(PACK_UNSIGNED_LONG, len(data.shape)))
-        for i in data.shape:
-            to_log.append(struct.pack(PACK_UNSIGNED_LONG, i))
-        to_log.append(b':')
+        dtype = data.dtype
+        try:
+            dtype_bytes = _DTYPE_STR_CACHE[dtype]
+        except KeyError:
+            dtype_bytes = _DTYPE_STR_CACHE[dtype] = dtype.str.encode('ascii')
 
-        # C or Fortran order
-        order = b'C'
-        if data.flags.f_contiguous:
-            order = b'F'
-        to_log.append(b':')
-        to_log.append(order)
-
-        # offset to record start
-        record_start = b''.join(to_log)
+        record_start = _encode_array_header(
+            group._path_bytes,
+            array_name_bytes,
+            nbytes,
+            dtype_bytes,
+            data.shape,
+            order,
+        )
+        if compression is not None:
+            # Compressed arrays have a different record type with the compression and the
+            # compressed size after the same fields of an uncompressed array.
+            compression_bytes = compression.encode('ascii')
+            compression_fields = bytearray(
+                1 + _sized_field_len(compression_bytes) + STRUCT_UNSIGNED_LONG.size)
+            compression_fields[0:1] = b':'
 
-        binary_stream.write(record_start)
-        binary_stream.write(data_as_bytes)
+            # long with compression size and compression
+            offset = _pack_sized_field_into(compression_fields, 1, compression_bytes)
 
-        if self._autoflush:
-            binary_stream.flush()
+            # long (number of bytes of the compressed data)
+            STRUCT_UNSIGNED_LONG.pack_into(compression_fields, offset, compressed_bytes_len)
 
-        log_stream = self._log_stream
-        log_stream.write(record_start)
-        log_stream.write(struct.pack(PACK_UNSIGNED_LONG, curr_offset))
+            record_start = b'ARRZ:' + record_start[4:] + compression_fields
 
-        # end record
-        log_stream.write(b'\n')
+        self._write_buffers(binary_stream, (record_start, data_buffer))
+        self._binary_offset += len(record_start) + len(data_buffer)
 
-        if self._autoflush:
-            log_stream.flush()
+        # offset to record start and end record
+        self._write_log_record(
+            (record_start, STRUCT_UNSIGNED_LONG.pack(curr_offset), b'\n'))
 
         return _Array(
             self,
@@ -547,7 +1548,9 @@ class _HBinseek(object):
             data.dtype,
             data.shape,
             order.decode('ascii'),
-            len(data_as_bytes),
+            nbytes,
+            compression,
+            compressed_bytes_len,
         )
 
     def __enter__(self, *args, **kwargs):
@@ -556,36 +1559,76 @@ class _HBinseek(object):
     def __exit__(self, *args, **kwargs):
         self.close()
 
-    def flush(self, write_metadata=True):
+    def flush(self, write_metadata=False):
+        '''
+        :param bool write_metadata:
+            Whether the metadata should also be rewritten (otherwise it's only rewritten when
+            closing or when the log grows more than the compact threshold -- readers replay the
+            log records written after it).
+        '''
         if self._mode != 'w':
             return
 
+        self._flush_streams()
+
         if write_metadata:
             self._flush_metadata()
 
-        self._binary_stream.flush()
-        self._log_stream.flush()
         self._dirty = False
 
     def _flush_metadata(self):
+        # The metadata must only refer to data which was already flushed.
+        self._flush_streams()
+
         # metadata always needs to be written as a whole
         metadata = self._root_group._to_json()
 
-        indent = 2
+        # Records in the log after this offset have to be replayed when reading.
+        metadata['log_offset'] = self._metadata_log_offset = self._log_offset
 
-        import json
-        dumped = json.dumps(metadata, indent=indent)
+        # Compact separators (formatting with indentation is much slower).
+        dumped = json.dumps(metadata, separators=(',', ':'), ensure_ascii=False)
         if not isinstance(dumped, bytes):
             dumped = dumped.encode('utf-8')
 
-        with file(self._metadata_filename, 'wb') as metadata_stream:
-            metadata_stream.write(dumped)
+        _write_file_atomically(self._metadata_filename, (dumped,))
+
+        # The json is kept as the portable (human-readable) format, but a marshal dump is also
+        # written to be loaded (much faster) when reading it back in the same Python version.
+        dumped = marshal.dumps(metadata)
+        if len(dumped) > METADATA_CACHE_COMPRESS_THRESHOLD:
+            header = METADATA_CACHE_ZLIB_HEADER
+            dumped = zlib.compress(dumped, 1)
+        else:
+            header = METADATA_CACHE_HEADER
+
+        _write_file_atomically(self._metadata_cache_filename, (header, dumped))
 
     def close(self):
-        if self._mode == 'w':
-            if self._write_metadata:
-                self._flush_metadata()
+        if self._closed:
+            return  # i.e.: closed inside a `with` block.
+        self._closed = True
 
+        if self._mode == 'w':
+            try:
+                if self._write_metadata:
+                    self._flush_metadata()
+                else:
+                    self._flush_streams()
+            finally:
+                if self._writer_thread is not None:
+                    self._write_queue.put(None)
+                    self._writer_thread.join()
+                    self._writer_thread = None
+                    self._write_queue = None
+
+                if self._preallocate_bytes:
+                    # Release the preallocated space which wasn't used.
+                    self._binary_stream.truncate(self._binary_offset)
+
+        # Note: the mmap is not explicitly closed as arrays returned from read_numpy() may still
+        # reference it (it's closed when the last reference is collected).
+        self._binary_mmap = None
         self._binary_stream.close()
         self._log_stream.close()
 
@@ -597,6 +1640,11 @@ def open(  # @ReservedAssignment
     log_filename=None,
     autoflush=True,
     write_metadata=True,
+    preload=False,
+    compact_threshold=DEFAULT_COMPACT_THRESHOLD,
+    background_writes=False,
+    preallocate_bytes=None,
+    use_metadata_cache=True,
 ):
     '''
     :param text_type filename:
@@ -604,6 +1652,25 @@ def open(  # @ReservedAssignment
 
     :param str mode:
         The mode to open the file (w or r).
+
+    :param bool preload:
+        Whether all the metadata should be loaded right away when opening for read (otherwise
+        it's loaded on demand).
+
+    :param int compact_threshold:
+        The number of bytes written to the log after which the metadata is rewritten when
+        opening for write.
+
+    :param bool background_writes:
+        Whether records should be written by a background thread when opening for write.
+
+    :param int preallocate_bytes:
+        The number of bytes to preallocate for the binary file when opening for write.
+
+    :param bool use_metadata_cache:
+        Whether the metadata cache (.hmeta) may be loaded when opening for read. Note: it's
+        trusted (it's a marshal dump, which isn't safe against malicious data), so, it should be
+        False to read untrusted files.
     '''
     return _HBinseek(
         filename,
@@ -611,4 +1678,9 @@ def open(  # @ReservedAssignment
         binary_data_filename,
         log_filename,
         autoflush=autoflush,
-        write_metadata=write_metadata)
+        write_metadata=write_metadata,
+        preload=preload,
+        compact_threshold=compact_threshold,
+        background_writes=background_writes,
+        preallocate_bytes=preallocate_bytes,
+        use_metadata_cache=use_metadata_cache)
@@ -38,7 +38,7 @@ def test_hbinseek(tmpdir):
         array = group.get_array('arr1')
         assert array.name == 'arr1'
         assert array.record_offset == 14
-        assert array.data_offset == 57
+        assert array.data_offset == 60
         assert array.dtype == numpy.int16
 
 #     print(open(f.filename).read())
@@ -58,7 +58,7 @@ def test_hbinseek(tmpdir):
         array = groupb.get_array('arr1')
         assert array.name == 'arr1'
         assert array.record_offset == 14
-        assert array.data_offset == 57
+        assert array.data_offset == 60
         assert array.dtype == numpy.int16
 
         read = array.read_numpy()
@@ -66,8 +66,8 @@ def test_hbinseek(tmpdir):
 
         array = groupb.get_array('arr2')
         assert array.name == 'arr2'
-        assert array.record_offset == 63
-        assert array.data_offset == 110
+        assert array.record_offset == 66
+        assert array.data_offset == 116
         assert array.dtype == numpy.int32
 
         read = array.read_numpy()
@@ -94,10 +94,24 @@ def test_hbinseek_manual_flush(tmpdir):
             assert len(read.list_groups()) == 1
 
 
+def test_hbinseek_close_twice(tmpdir):
+    import hbinseek
+    import os
+    filename = os.path.join(str(tmpdir), 'check.hbinseek')
+    with hbinseek.open(filename, 'w') as f:
+        f.create_group('/A')
+        f.close()
+
+    with hbinseek.open(filename, 'r') as f:
+        assert f.list_groups() == ['A']
+        f.close()
+
 def test_hbinseek_restore_metadata_from_log(tmpdir):
     import hbinseek
     import os
+    import numpy
     filename = os.path.join(str(tmpdir), 'check.hbinseek')
+    arr = numpy.array([[1, 2], [3, 4]], dtype=numpy.int32)
     with hbinseek.open(filename, 'w', autoflush=True, write_metadata=False) as f:
         group = f.create_group('/A')
         group.set_attr('unicode', 'a')
@@ -105,3 +119,489 @@ def test_hbinseek_restore_metadata_from_log(tmpdir):
         group.set_attr('int', 1)
         group.set_attr('long', 2**32)
         group.set_attr('float', 1.5)
+        f.create_group('/A/B').create_array('arr', arr)
+        f.create_group('/C')
+
+    assert not os.path.exists(filename)
+    with hbinseek.open(filename, 'r') as f:
+        assert len(f) == 3
+        group = f['/A']
+        assert group.get_attr('unicode') == 'a'
+        assert group.get_attr('bytes') == b'a'
+        assert group.get_attr('int') == 1
+        assert group.get_attr('long') == 2**32
+        assert group.get_attr('float') == 1.5
+        assert numpy.array_equal(f['/A/B'].get_array('arr').read_numpy(), arr)
+
+    # An incomplete record at the end of the log (i.e.: still being written) is skipped.
+    with open(f.log_filename, 'ab') as stream:
+        stream.write(b'ATTR:\x05')
+    with hbinseek.open(filename, 'r') as f:
+        assert len(f) == 3
+
+
+def test_hbinseek_replay_log_after_metadata(tmpdir):
+    import hbinseek
+    import os
+    import numpy
+    filename = os.path.join(str(tmpdir), 'check.hbinseek')
+    arr = numpy.array([1, 2, 3], dtype=numpy.float32)
+    with hbinseek.open(filename, 'w', compact_threshold=50) as f:
+        f.create_group('/A').create_array('arr', arr)
+        assert not os.path.exists(filename)
+
+        # The log is big enough to rewrite the metadata.
+        f.create_group('/A').set_attr('attr', 1)
+        assert os.path.exists(filename)
+        f.create_group('/B')
+
+        with hbinseek.open(filename, 'r') as read:
+            assert set(read.list_groups()) == {'A', 'B'}
+            assert read['/A'].get_attr('attr') == 1
+            assert numpy.array_equal(read['/A'].get_array('arr').read_numpy(), arr)
+
+
+def test_hbinseek_fortran_order(tmpdir):
+    import hbinseek
+    import os
+    import numpy
+    import pytest
+
+    filename = os.path.join(str(tmpdir), 'check.hbin')
+    arr = numpy.asfortranarray(numpy.arange(6, dtype=numpy.float64).reshape(2, 3))
+    non_contiguous = numpy.arange(12, dtype=numpy.int32).reshape(3, 4)[:, ::2]
+    with hbinseek.open(filename, 'w') as f:
+        group = f.create_group('/A')
+        group.create_array('fortran', arr)
+        group.create_array('non_contiguous', non_contiguous)
+
+    with hbinseek.open(filename, 'r') as f:
+        array = f['/A'].get_array('fortran')
+        assert array.order == 'F'
+        assert numpy.array_equal(array.read_numpy(), arr)
+
+        array = f['/A'].get_array('non_contiguous')
+        assert array.order == 'C'
+        assert numpy.array_equal(array.read_numpy(), non_contiguous)
+
+        # Chunks are read in the order the elements are stored.
+        assert numpy.array_equal(array.read_chunk(1, 3), non_contiguous.ravel('C')[1:4])
+        assert numpy.array_equal(
+            f['/A'].get_array('fortran').read_chunk(2, 4), arr.ravel('F')[2:6])
+        assert len(array.read_chunk(6, 0)) == 0
+        with pytest.raises(ValueError):
+            array.read_chunk(4, 3)
+
+
+def test_hbinseek_lazy_load(tmpdir):
+    import hbinseek
+    import os
+    import numpy
+    import pytest
+
+    filename = os.path.join(str(tmpdir), 'check.hbin')
+    arr = numpy.array([1, 2, 3], dtype=numpy.int16)
+    with hbinseek.open(filename, 'w') as f:
+        f.create_group('/A/B/C').create_array('arr', arr)
+        f.create_group('/A/D')
+
+    for preload in (False, True):
+        with hbinseek.open(filename, 'r', preload=preload) as f:
+            group = f['/A/B/C']
+            assert group.path == '/A/B/C'
+            assert numpy.array_equal(group.get_array('arr').read_numpy(), arr)
+            with pytest.raises(KeyError):
+                f['/A/E']
+            assert '/A/B' in f
+            assert '/A/E' not in f
+            assert '/E/F' not in f
+            assert f.get_array('/A/B/C', 'arr').name == 'arr'
+            assert f.get_array('/A/B/C', 'arr') is group.get_array('arr')
+            assert set(f['/A'].list_groups()) == {'B', 'D'}
+            assert len(f) == 4
+
+    # The shape is the same when loaded from the metadata cache or from the json.
+    for metadata_cache_filename in (None, os.path.splitext(filename)[0] + '.hmeta'):
+        if metadata_cache_filename is not None:
+            os.remove(metadata_cache_filename)
+        with hbinseek.open(filename, 'r') as f:
+            assert f.get_array('/A/B/C', 'arr').shape == (3,)
+
+
+def test_hbinseek_metadata_cache(tmpdir, monkeypatch):
+    import hbinseek
+    import marshal
+    import os
+
+    filename = os.path.join(str(tmpdir), 'check.hbin')
+    with hbinseek.open(filename, 'w') as f:
+        f.create_group('/A').set_attr('attr', 'value')
+        metadata_cache_filename = f.metadata_cache_filename
+
+    assert os.path.exists(metadata_cache_filename)
+    with hbinseek.open(filename, 'r') as f:
+        assert f['/A'].get_attr('attr') == 'value'
+
+    # The cache is skipped if asked for.
+    with open(metadata_cache_filename, 'rb') as stream:
+        header = stream.readline()
+        metadata = marshal.load(stream)
+    metadata['children'][0]['attrs']['attr'] = 'cached'
+    with open(metadata_cache_filename, 'wb') as stream:
+        stream.write(header + marshal.dumps(metadata))
+    with hbinseek.open(filename, 'r') as f:
+        assert f['/A'].get_attr('attr') == 'cached'
+    with hbinseek.open(filename, 'r', use_metadata_cache=False) as f:
+        assert f['/A'].get_attr('attr') == 'value'
+
+    # The json is used when the cache is not valid.
+    for contents in (b'invalid', header + marshal.dumps([1, 2]), header + marshal.dumps({})):
+        with open(metadata_cache_filename, 'wb') as stream:
+            stream.write(contents)
+        with hbinseek.open(filename, 'r') as f:
+            assert f['/A'].get_attr('attr') == 'value'
+
+    os.remove(metadata_cache_filename)
+    with hbinseek.open(filename, 'r') as f:
+        assert f['/A'].get_attr('attr') == 'value'
+
+    monkeypatch.setattr(hbinseek, 'METADATA_CACHE_COMPRESS_THRESHOLD', 0)
+    with hbinseek.open(filename, 'w') as f:
+        f.create_group('/A').set_attr('attr', 'compressed')
+
+    with open(metadata_cache_filename, 'rb') as stream:
+        assert stream.readline() == hbinseek.METADATA_CACHE_ZLIB_HEADER
+    with hbinseek.open(filename, 'r') as f:
+        assert f['/A'].get_attr('attr') == 'compressed'
+
+
+def test_hbinseek_attr_subclasses(tmpdir):
+    import enum
+    import hbinseek
+    import os
+    import numpy
+
+    class MyEnum(enum.IntEnum):
+        VALUE = 2
+
+    filename = os.path.join(str(tmpdir), 'check.hbin')
+    with hbinseek.open(filename, 'w') as f:
+        group = f.create_group('/A')
+        group.set_attr('float', numpy.float64(1.5))
+        group.set_attr('enum', MyEnum.VALUE)
+        # bool is a subclass of int, but it's kept as a bool.
+        group.set_attr('true', True)
+        group.set_attr('false', False)
+        metadata_cache_filename = f.metadata_cache_filename
+
+    # Read through the metadata cache, the json and the log.
+    for remove in (None, metadata_cache_filename, filename):
+        if remove is not None:
+            os.remove(remove)
+        with hbinseek.open(filename, 'r') as f:
+            group = f['/A']
+            assert group.get_attr('float') == 1.5
+            assert type(group.get_attr('float')) is float
+            assert group.get_attr('enum') == 2
+            assert type(group.get_attr('enum')) is int
+            assert group.get_attr('true') is True
+            assert group.get_attr('false') is False
+
+
+def test_hbinseek_attr_int_range(tmpdir):
+    import hbinseek
+    import os
+    import pytest
+
+    filename = os.path.join(str(tmpdir), 'check.hbin')
+    with hbinseek.open(filename, 'w') as f:
+        group = f.create_group('/A')
+        group.set_attr('max', 2 ** 63 - 1)
+        group.set_attr('min', -2 ** 63)
+        # Integers are saved as a signed 64-bit long.
+        for value in (2 ** 64, 2 ** 63, -2 ** 63 - 1):
+            with pytest.raises(ValueError):
+                group.set_attr('out_of_range', value)
+
+    os.remove(filename)  # Read from the log.
+    with hbinseek.open(filename, 'r') as f:
+        group = f['/A']
+        assert group.get_attr('max') == 2 ** 63 - 1
+        assert group.get_attr('min') == -2 ** 63
+        assert sorted(group.list_attrs()) == ['max', 'min']
+
+def test_hbinseek_background_writes(tmpdir):
+    import hbinseek
+    import os
+    import numpy
+
+    filename = os.path.join(str(tmpdir), 'check.hbin')
+    arr = numpy.arange(10, dtype=numpy.int64)
+    with hbinseek.open(filename, 'w', background_writes=True) as f:
+        group = f.create_group('/A')
+        for i in range(100):
+            group.create_array('arr%s' % (i,), arr)
+            # Changing the array after it's queued must not change what's written.
+            arr += 1
+        group.set_attr('attr', 1)
+
+        f.flush()
+        with hbinseek.open(filename, 'r') as read:
+            assert read['/A'].get_attr('attr') == 1
+            assert numpy.array_equal(read['/A'].get_array('arr99').read_numpy(), arr - 1)
+
+    with hbinseek.open(filename, 'r') as f:
+        group = f['/A']
+        for i in range(100):
+            assert numpy.array_equal(
+                group.get_array('arr%s' % (i,)).read_numpy(), numpy.arange(10) + i)
+
+
+def test_hbinseek_compression(tmpdir):
+    import hbinseek
+    import os
+    import numpy
+    import pytest
+
+    arr = numpy.zeros((100, 10), dtype=numpy.float64)
+    arr[:, 0] = numpy.arange(100)
+    for write_metadata in (True, False):
+        filename = os.path.join(str(tmpdir), 'check%s.hbin' % (write_metadata,))
+        with hbinseek.open(filename, 'w', write_metadata=write_metadata) as f:
+            group = f.create_group('/A')
+            group.create_array('compressed', arr, compression='zlib')
+            group.create_array('uncompressed', arr)
+            with pytest.raises(ValueError):
+                group.create_array('invalid', arr, compression='invalid')
+
+        assert os.path.getsize(f.binary_data_filename) < arr.nbytes * 1.5
+
+        with hbinseek.open(filename, 'r') as f:
+            array = f['/A'].get_array('compressed')
+            assert array.compression == 'zlib'
+            assert array.bytes_len == arr.nbytes
+            assert numpy.array_equal(array.read_numpy(), arr)
+            assert numpy.array_equal(array.read_chunk(10, 25), arr.ravel()[10:35])
+            assert len(array.read_chunk(0, 0)) == 0
+
+            array = f['/A'].get_array('uncompressed')
+            assert array.compression is None
+            assert numpy.array_equal(array.read_numpy(), arr)
+
+
+def test_hbinseek_preallocate(tmpdir, monkeypatch):
+    import errno
+    import hbinseek
+    import os
+    import numpy
+    import pytest
+
+    filename = os.path.join(str(tmpdir), 'check.hbin')
+    preallocate_bytes = 1024 * 1024
+    arr = numpy.arange(10, dtype=numpy.int64)
+    for autoflush in (True, False):
+        with hbinseek.open(filename, 'w', autoflush=autoflush, preallocate_bytes=preallocate_bytes) as f:
+            binary_data_filename = f.binary_data_filename
+            assert os.path.getsize(binary_data_filename) == preallocate_bytes
+            group = f.create_group('/A')
+            group.create_array('arr1', arr)
+            group.create_array('arr2', arr * 2)
+
+        # The space not used is released.
+        assert os.path.getsize(binary_data_filename) < preallocate_bytes
+
+        with hbinseek.open(filename, 'r') as f:
+            assert numpy.array_equal(f['/A'].get_array('arr1').read_numpy(), arr)
+            assert numpy.array_equal(f['/A'].get_array('arr2').read_numpy(), arr * 2)
+
+    # Without posix_fallocate the file is truncated (which must not shrink it).
+    monkeypatch.setattr(hbinseek, '_posix_fallocate', None)
+    for preallocate_bytes in (8, 1024):
+        with hbinseek.open(filename, 'w', preallocate_bytes=preallocate_bytes) as f:
+            f.create_group('/A').create_array('arr1', arr)
+
+        with open(binary_data_filename, 'rb') as stream:
+            assert stream.read(len(hbinseek.BINARY_HEADER)) == hbinseek.BINARY_HEADER
+        with hbinseek.open(filename, 'r') as f:
+            assert numpy.array_equal(f['/A'].get_array('arr1').read_numpy(), arr)
+
+    # The file is only truncated if preallocating isn't supported (other errors are raised).
+    def posix_fallocate(fileno, offset, size):
+        raise OSError(fallocate_errno, os.strerror(fallocate_errno))
+
+    monkeypatch.setattr(hbinseek, '_posix_fallocate', posix_fallocate)
+    fallocate_errno = errno.EOPNOTSUPP
+    with hbinseek.open(filename, 'w', preallocate_bytes=preallocate_bytes) as f:
+        assert os.path.getsize(binary_data_filename) == preallocate_bytes
+
+    fallocate_errno = errno.ENOSPC
+    with pytest.raises(OSError) as e:
+        hbinseek.open(filename, 'w', preallocate_bytes=preallocate_bytes)
+    assert e.value.errno == errno.ENOSPC
+
+
+def test_hbinseek_direct_writes(tmpdir):
+    import hbinseek
+    import os
+    import numpy
+
+    filename = os.path.join(str(tmpdir), 'check.hbin')
+    small = numpy.arange(10, dtype=numpy.int64)
+    # Bigger than hbinseek.DIRECT_WRITE_THRESHOLD (written without going through the buffer).
+    big = numpy.arange(hbinseek.DIRECT_WRITE_THRESHOLD, dtype=numpy.int64)
+    with hbinseek.open(filename, 'w', autoflush=False) as f:
+        group = f.create_group('/A')
+        for i in range(3):
+            group.create_array('small%s' % (i,), small + i)
+            group.create_array('big%s' % (i,), big + i)
+
+    with hbinseek.open(filename, 'r') as f:
+        group = f['/A']
+        for i in range(3):
+            assert numpy.array_equal(group.get_array('small%s' % (i,)).read_numpy(), small + i)
+            assert numpy.array_equal(group.get_array('big%s' % (i,)).read_numpy(), big + i)
+
+
+def test_hbinseek_threaded_reads(tmpdir):
+    import hbinseek
+    import os
+    import threading
+    import numpy
+
+    filename = os.path.join(str(tmpdir), 'check.hbin')
+    arr = numpy.arange(10, dtype=numpy.int64)
+    with hbinseek.open(filename, 'w') as f:
+        for i in range(50):
+            f.create_group('/A/B%s/C' % (i,)).create_array('arr', arr + i)
+
+    errors = []
+    with hbinseek.open(filename, 'r') as f:
+
+        def read():
+            try:
+                for i in range(50):
+                    read_arr = f.get_array('/A/B%s/C' % (i,), 'arr').read_numpy()
+                    assert numpy.array_equal(read_arr, arr + i)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=read) for _i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert not errors
+        assert len(f) == 101
+
+
+def test_hbinseek_log_after_binary(tmpdir):
+    import hbinseek
+    import os
+    import numpy
+
+    filename = os.path.join(str(tmpdir), 'check.hbin')
+    arr = numpy.arange(10, dtype=numpy.int64)
+    with hbinseek.open(filename, 'w', autoflush=False, write_metadata=False) as f:
+        group = f.create_group('/A')
+        group.create_array('arr', arr)
+        # Enough records for the log to be written before flush() is called.
+        for i in range(40000):
+            group.set_attr('attr', i)
+
+        assert os.path.getsize(f.log_filename) > len(hbinseek.LOG_HEADER)
+        # Whatever is in the log must refer to data already in the binary file.
+        with hbinseek.open(filename, 'r') as read:
+            assert numpy.array_equal(read['/A'].get_array('arr').read_numpy(), arr)
+
+
+def test_hbinseek_rewrite(tmpdir):
+    import hbinseek
+    import os
+
+    filename = os.path.join(str(tmpdir), 'check.hbin')
+    with hbinseek.open(filename, 'w') as f:
+        for i in range(20):
+            f.create_group('/Old%s' % (i,))
+
+    # The metadata of the previous session must not be used with the new log.
+    with hbinseek.open(filename, 'w', write_metadata=False) as f:
+        f.create_group('/New')
+        with hbinseek.open(filename, 'r') as read:
+            assert read.list_groups() == ['New']
+
+    with hbinseek.open(filename, 'r') as f:
+        assert f.list_groups() == ['New']
+
+
+def test_hbinseek_create_group_on_read(tmpdir):
+    import hbinseek
+    import os
+
+    filename = os.path.join(str(tmpdir), 'check.hbin')
+    with hbinseek.open(filename, 'w') as f:
+        f.create_group('/A').set_attr('attr', 1)
+
+    with hbinseek.open(filename, 'r') as f:
+        # The group loaded from the metadata is provided (and not a new empty group).
+        assert f.create_group('/A').list_attrs() == ['attr']
+        assert f['/A'].get_attr('attr') == 1
+
+
+def test_hbinseek_corrupted_log(tmpdir):
+    import hbinseek
+    import os
+    import pytest
+
+    filename = os.path.join(str(tmpdir), 'check.hbin')
+    with hbinseek.open(filename, 'w', write_metadata=False) as f:
+        f.create_group('/A')
+        f.create_group('/B')
+        log_filename = f.log_filename
+
+    with open(log_filename, 'rb') as stream:
+        contents = stream.read()
+    second_record = contents.index(b'GRP:', contents.index(b'GRP:') + 1)
+    with open(log_filename, 'wb') as stream:
+        stream.write(contents[:second_record] + b'BAD:' + contents[second_record + 4:])
+
+    with hbinseek.open(filename, 'r') as f:
+        # The groups partially restored are never provided.
+        for _i in range(2):
+            with pytest.raises(IOError):
+                f.list_groups()
+
+
+def test_hbinseek_v001_log(tmpdir):
+    import hbinseek
+    import json
+    import os
+    import pytest
+
+    filename = os.path.join(str(tmpdir), 'check.hbin')
+    with hbinseek.open(filename, 'w') as f:
+        f.create_group('/A/B')
+        log_filename = f.log_filename
+        metadata_cache_filename = f.metadata_cache_filename
+
+    # Make it as written by the first version of the format (records in the log refer to the
+    # group name, so, it can't be replayed and the metadata doesn't have the log offset).
+    with open(log_filename, 'rb') as stream:
+        contents = stream.read()
+    with open(log_filename, 'wb') as stream:
+        stream.write(hbinseek.LOG_HEADER_V001 + contents[len(hbinseek.LOG_HEADER):])
+    with open(filename, 'r') as stream:
+        metadata = json.load(stream)
+    del metadata['log_offset']
+    with open(filename, 'w') as stream:
+        json.dump(metadata, stream)
+    os.remove(metadata_cache_filename)
+
+    with hbinseek.open(filename, 'r') as f:
+        assert f.list_groups() == ['A']
+        assert len(f) == 2
+
+    os.remove(filename)
+    with hbinseek.open(filename, 'r') as f:
+        with pytest.raises(IOError):
+            f.list_groups()